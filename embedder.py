@@ -1,13 +1,16 @@
 import os
-from typing import List
+import re
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
 import logging
 
-try:
-    import openai
-    HAS_OPENAI = True
-except ImportError:
-    HAS_OPENAI = False
-    logging.warning("openai не установлен. Embedder будет использовать заглушки.")
+import numpy as np
 
 try:
     from dotenv import load_dotenv
@@ -18,30 +21,355 @@ except ImportError:
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
-# Настройка API
-if HAS_OPENAI:
+# Модель эмбеддингов OpenAI
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-large")
+# Размер батча для одного запроса к API (text-embedding-3-large принимает до ~100 входов)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "96"))
+# Количество повторов батча при временной ошибке API (с экспоненциальной задержкой)
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "3"))
+# Максимум одновременных запросов к API
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+# SQLite-кэш эмбеддингов (float16) по (model, sha256(text)); пустое значение отключает кэш
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".leann/embed_cache.sqlite")
+# Максимальное расстояние Хэмминга между SimHash чанков, при котором вектор
+# похожего чанка переиспользуется (отрицательное значение отключает поиск).
+# Поиск по полосам гарантированно находит соседей только при расстоянии <= 5
+EMBED_SIMHASH_DISTANCE = int(os.getenv("EMBED_SIMHASH_DISTANCE", "5"))
+
+# SimHash строится по отдельным словам: замена одного слова меняет один-два
+# признака (у шинглов из 3 слов - до шести), поэтому правки вроде опечаток
+# почти не сдвигают хэш. Для коротких текстов он неустойчив
+_SIMHASH_MIN_TOKENS = 16
+# 64 бита делятся на 6 полос: при расстоянии <= 5 хотя бы одна полоса совпадает
+_SIMHASH_BAND_BITS = (11, 11, 11, 11, 10, 10)
+_SIMHASH_MASK = (1 << 64) - 1
+
+# Версия схемы кэша: при несовпадении таблицы пересоздаются
+# (2: векторы хранятся во float16, 3: SimHash по словам, 6 полос)
+_CACHE_SCHEMA_VERSION = 3
+# float16 вдвое компактнее float32, а ошибка косинусной близости < 0.01
+_CACHE_DTYPE = np.float16
+# Соединение SQLite нельзя использовать из другого потока, поэтому у каждого
+# потока своё; схема создаётся один раз, первым открывшим кэш потоком
+_cache_local = threading.local()
+_cache_lock = threading.Lock()
+_cache_ready = False
+_cache_failed = False
+
+# openai импортируется при первом вызове embedder, а не при загрузке модуля
+_openai = None
+_openai_checked = False
+
+
+def _get_openai():
+    """Ленивый импорт и настройка openai (None, если пакет не установлен)"""
+    global _openai, _openai_checked
+    if _openai_checked:
+        return _openai
+    _openai_checked = True
+    try:
+        import openai
+    except ImportError:
+        logging.warning("openai не установлен. Embedder будет использовать заглушки.")
+        return None
+    if not hasattr(openai, 'Embedding') or hasattr(openai, 'OpenAI'):
+        # В openai>=1.0 openai.Embedding всегда бросает APIRemovedInV1
+        logging.warning("Установлен openai>=1.0, нужен openai<1 (см. requirements.txt). "
+                        "Embedder будет использовать заглушки.")
+        return None
+
+    # Настройка API
     if OPENAI_API_KEY:
         openai.api_key = OPENAI_API_KEY
     elif OPENROUTER_API_KEY:
         openai.api_key = OPENROUTER_API_KEY
     else:
         logging.warning("Нет ключа для OpenAI/OpenRouter. Embedder будет возвращать заглушки.")
+    _openai = openai
+    return _openai
 
 
 # Можно реализовать через модель text-embedding-3-large или аналог
 
-def embed_chunk(text: str, model: str = "text-embedding-3-large") -> List[float]:
-    """Вычисление embedding для одного чанка"""
-    if HAS_OPENAI and openai.api_key:
-        try:
-            response = openai.Embedding.create(
-                input=[text],
-                model=model
+def _stub_embedding(text: str) -> List[float]:
+    """Заглушка, если нет ключа или пакета"""
+    return [float(hash(text) % 1000) / 1000.0] * 10
+
+
+def _get_cache() -> Optional[sqlite3.Connection]:
+    """Ленивое открытие SQLite-кэша для текущего потока (None, если кэш отключён или недоступен)"""
+    global _cache_ready, _cache_failed
+    if _cache_failed or not EMBED_CACHE_PATH:
+        return None
+    conn = getattr(_cache_local, 'conn', None)
+    if conn is not None:
+        return conn
+    try:
+        cache_path = Path(EMBED_CACHE_PATH)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(cache_path))
+        with _cache_lock:
+            if not _cache_ready:
+                _init_cache(conn)
+                _cache_ready = True
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Кэш эмбеддингов недоступен ({EMBED_CACHE_PATH}): {e}")
+        _cache_failed = True
+        return None
+    _cache_local.conn = conn
+    return conn
+
+
+def _init_cache(conn: sqlite3.Connection) -> None:
+    """Создание (или пересоздание при смене версии) таблиц кэша"""
+    if conn.execute("PRAGMA user_version").fetchone()[0] != _CACHE_SCHEMA_VERSION:
+        conn.execute("DROP TABLE IF EXISTS emb")
+        conn.execute("DROP TABLE IF EXISTS emb_simhash")
+        conn.execute(f"PRAGMA user_version = {_CACHE_SCHEMA_VERSION}")
+    conn.execute("CREATE TABLE IF NOT EXISTS emb(key BLOB PRIMARY KEY, vec BLOB)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS emb_simhash("
+        "key BLOB PRIMARY KEY, model TEXT, simhash INTEGER, "
+        + ", ".join(f"b{band} INTEGER" for band in range(len(_SIMHASH_BAND_BITS))) + ")"
+    )
+    for band in range(len(_SIMHASH_BAND_BITS)):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS emb_simhash_b{band} ON emb_simhash(model, b{band})")
+    conn.commit()
+
+
+def _cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256((model + "\x00" + text).encode('utf-8')).digest()
+
+
+def _simhash(text: str) -> Optional[int]:
+    """64-битный SimHash по словам (None для слишком коротких текстов)"""
+    tokens = re.findall(r'\w+', text.lower())
+    if len(tokens) < _SIMHASH_MIN_TOKENS:
+        return None
+    counts = Counter(tokens)
+    digests = b''.join(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest() for token in counts)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    # Сублинейный вес 1 + ln(tf): частые служебные слова не перевешивают остальные,
+    # иначе несвязанные разделы получают близкие хэши
+    weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+    votes = (bits * weights[:, None]).sum(axis=0) * 2 > weights.sum()
+    return int.from_bytes(np.packbits(votes, bitorder='little').tobytes(), 'little')
+
+
+def _simhash_bands(simhash: int) -> List[int]:
+    bands = []
+    shift = 0
+    for bits in _SIMHASH_BAND_BITS:
+        bands.append((simhash >> shift) & ((1 << bits) - 1))
+        shift += bits
+    return bands
+
+
+def _similar_vector(model: str, simhash: int) -> Optional[List[float]]:
+    """Поиск в кэше вектора чанка с близким SimHash"""
+    conn = _get_cache()
+    if conn is None:
+        return None
+    bands = _simhash_bands(simhash)
+    try:
+        rows = conn.execute(
+            "SELECT key, simhash FROM emb_simhash WHERE model = ? AND ("
+            + " OR ".join(f"b{band} = ?" for band in range(len(bands))) + ")",
+            (model, *bands)
+        ).fetchall()
+    except sqlite3.Error as e:
+        # Ошибка чтения (например, database is locked) - просто промах кэша
+        logging.warning(f"Ошибка чтения кэша эмбеддингов: {e}")
+        return None
+    for key, other in rows:
+        if bin((other & _SIMHASH_MASK) ^ simhash).count('1') <= EMBED_SIMHASH_DISTANCE:
+            try:
+                return _cached_vector(key)
+            except KeyError:
+                continue
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _cached_blob(key: bytes) -> bytes:
+    """Сырой вектор (float16-байты) из SQLite-кэша
+
+    В lru_cache хранятся байты, а не списки float - так запись занимает
+    ~6 КиБ на 3072 измерения вместо ~100 КиБ.
+    При промахе (и при ошибке чтения SQLite) бросает KeyError: исключения
+    lru_cache не запоминает, поэтому вектор, добавленный позже, будет найден.
+    """
+    conn = _get_cache()
+    if conn is None:
+        raise KeyError(key)
+    try:
+        row = conn.execute("SELECT vec FROM emb WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Ошибка чтения кэша эмбеддингов: {e}")
+        raise KeyError(key) from e
+    if row is None:
+        raise KeyError(key)
+    return row[0]
+
+
+def _cached_vector(key: bytes) -> List[float]:
+    """Вектор из кэша (KeyError при промахе)"""
+    return np.frombuffer(_cached_blob(key), dtype=_CACHE_DTYPE).astype(np.float32).tolist()
+
+
+def _store_vectors(keys: List[bytes], vectors: List[List[float]],
+                   model: Optional[str] = None, simhashes: Optional[List[Optional[int]]] = None) -> None:
+    """Сохранение векторов (и их SimHash, если переданы) в кэш одной транзакцией"""
+    conn = _get_cache()
+    if conn is None:
+        return
+    rows = [(key, np.asarray(vector, dtype=_CACHE_DTYPE).tobytes()) for key, vector in zip(keys, vectors)]
+    simhash_rows = []
+    for key, simhash in zip(keys, simhashes or []):
+        if simhash is not None:
+            # SQLite хранит знаковые 64-битные целые
+            signed = simhash - (1 << 64) if simhash >> 63 else simhash
+            simhash_rows.append((key, model, signed, *_simhash_bands(simhash)))
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO emb(key, vec) VALUES (?, ?)", rows)
+            band_columns = [f"b{band}" for band in range(len(_SIMHASH_BAND_BITS))]
+            conn.executemany(
+                f"INSERT OR REPLACE INTO emb_simhash(key, model, simhash, {', '.join(band_columns)}) "
+                f"VALUES (?, ?, ?, {', '.join('?' * len(band_columns))})",
+                simhash_rows
             )
-            return response['data'][0]['embedding']
+    except sqlite3.Error as e:
+        logging.warning(f"Ошибка записи в кэш эмбеддингов: {e}")
+
+
+def _is_transient(openai, error: Exception) -> bool:
+    """Временная ошибка API (лимит, таймаут, обрыв соединения, 5xx), которую имеет смысл повторить"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    errors = getattr(openai, 'error', None)
+    if errors is None:
+        return False
+    transient = tuple(
+        getattr(errors, name)
+        for name in ('RateLimitError', 'Timeout', 'APIConnectionError', 'ServiceUnavailableError', 'TryAgain')
+        if hasattr(errors, name)
+    )
+    if isinstance(error, transient):
+        return True
+    status = getattr(error, 'http_status', None)
+    return isinstance(error, errors.APIError) and status is not None and status >= 500
+
+
+async def _request_embeddings(batch: List[str], model: str, semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """Один запрос к API для батча с повторами при временных ошибках
+
+    Постоянные ошибки (авторизация, неверный запрос) не повторяются.
+    Одновременно выполняется не больше EMBED_CONCURRENCY запросов.
+    Порядок результата восстанавливается по полю index ответа.
+    """
+    openai = _get_openai()
+    delay = 1.0
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await openai.Embedding.acreate(
+                    input=batch,
+                    model=model
+                )
+            vectors = [None] * len(batch)
+            for item in response['data']:
+                vectors[item['index']] = item['embedding']
+            return vectors
         except Exception as e:
-            logging.warning(f"Ошибка embedding: {e}. Возвращаю пустой вектор.")
-            return [0.0] * 1024
-    else:
-        # Заглушка, если нет ключа или пакета
-        return [float(hash(text) % 1000) / 1000.0] * 10
+            if attempt == EMBED_MAX_RETRIES or not _is_transient(openai, e):
+                raise
+            logging.warning(f"Ошибка embedding батча ({len(batch)} шт.): {e}. Повтор через {delay:.0f} с.")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def embed_chunks_async(texts: List[str], model: str = EMBED_MODEL,
+                             fallback: bool = True) -> List[Optional[List[float]]]:
+    """Вычисление embedding для списка чанков батчами по EMBED_BATCH_SIZE
+
+    Батчи отправляются в API параллельно (до EMBED_CONCURRENCY запросов).
+
+    Векторы неизменившихся чанков берутся из кэша (EMBED_CACHE_PATH),
+    для слегка изменённых переиспользуется вектор похожего чанка (SimHash),
+    в API уходят только промахи.
+
+    Args:
+        texts: Тексты чанков
+        model: Модель эмбеддингов
+        fallback: Возвращать заглушки, если API недоступен (нет пакета или ключа).
+            При False на их месте будет None
+
+    Returns:
+        Список векторов в том же порядке, что и texts.
+        Для чанков, чей батч не удался после повторов, - None
+    """
+    openai = _get_openai()
+    if not (openai and openai.api_key):
+        if not fallback:
+            return [None] * len(texts)
+        return [_stub_embedding(text) for text in texts]
+
+    keys = [_cache_key(model, text) for text in texts]
+    vectors = [None] * len(texts)
+    missing = []
+    for i, key in enumerate(keys):
+        try:
+            vectors[i] = _cached_vector(key)
+        except KeyError:
+            missing.append(i)
+
+    simhashes = {}
+    if EMBED_SIMHASH_DISTANCE >= 0 and missing and _get_cache() is not None:
+        reused = []
+        for i in missing:
+            simhashes[i] = _simhash(texts[i])
+            vector = _similar_vector(model, simhashes[i]) if simhashes[i] is not None else None
+            if vector is None:
+                continue
+            vectors[i] = vector
+            reused.append(i)
+        if reused:
+            logging.debug(f"Переиспользовано {len(reused)} векторов похожих чанков")
+            # Сохраняем под точным ключом без SimHash, чтобы похожие чанки не "дрейфовали"
+            _store_vectors([keys[i] for i in reused], [vectors[i] for i in reused])
+            missing = [i for i in missing if vectors[i] is None]
+
+    batches = [missing[start:start + EMBED_BATCH_SIZE] for start in range(0, len(missing), EMBED_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    results = await asyncio.gather(
+        *[_request_embeddings([texts[i] for i in batch_idx], model, semaphore) for batch_idx in batches],
+        return_exceptions=True
+    )
+
+    for batch_idx, batch_vectors in zip(batches, results):
+        if isinstance(batch_vectors, Exception):
+            logging.warning(f"Ошибка embedding: {batch_vectors}. Векторы для батча не получены.")
+            continue
+        for i, vector in zip(batch_idx, batch_vectors):
+            vectors[i] = vector
+        _store_vectors([keys[i] for i in batch_idx], batch_vectors,
+                       model=model, simhashes=[simhashes.get(i) for i in batch_idx])
+
+    # Для чанков неудавшихся батчей остаётся None: размерность выдумывать нельзя,
+    # иначе в один индекс попадут векторы разной длины
+    return vectors
+
+
+def embed_chunks(texts: List[str], model: str = EMBED_MODEL,
+                 fallback: bool = True) -> List[Optional[List[float]]]:
+    """Синхронная обёртка над embed_chunks_async
+
+    Нельзя вызывать из уже запущенного event loop - там используйте embed_chunks_async.
+    """
+    return asyncio.run(embed_chunks_async(texts, model=model, fallback=fallback))
+
+
+def embed_chunk(text: str, model: str = EMBED_MODEL) -> Optional[List[float]]:
+    """Вычисление embedding для одного чанка"""
+    return embed_chunks([text], model=model)[0]
@@ -1,12 +1,21 @@
 import os
 import sys
 import logging
+from itertools import chain
 from pathlib import Path
 import typer
 from dotenv import load_dotenv
-from rag_utils import process_markdown_docs
+from rag_utils import iter_markdown_docs
 from vector_store import get_vector_store
 
+# orjson сериализует отчёт в разы быстрее стандартного json
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    import json
+    HAS_ORJSON = False
+
 app = typer.Typer()
 
 # Логгирование
@@ -18,6 +27,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def write_report(report: dict, report_file: str) -> None:
+    """Сохраняет отчёт об обработке в JSON"""
+    if HAS_ORJSON:
+        with open(report_file, 'wb') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+class ProcessingError(Exception):
+    """Ошибка чтения или обработки документов (в отличие от ошибки загрузки в LEANN)"""
+
+
+def _guard_processing(chunks):
+    """Помечает исключения из потока чанков как ошибки обработки docs"""
+    try:
+        yield from chunks
+    except Exception as e:
+        raise ProcessingError(e) from e
+
+
+def _processing_failed(e: Exception) -> None:
+    logger.exception('Ошибка при обработке docs:')
+    typer.echo(f'Ошибка: {e}')
+    sys.exit(1)
+
 @app.command()
 def run(
     docs_path: str = typer.Option('docs', help='Путь к папке с документацией'),
@@ -37,36 +72,40 @@ def run(
     os.makedirs('logs', exist_ok=True)
     logger.info(f'Обработка папки {docs_dir}')
 
-    try:
-        auto_generate_yaml = not no_auto_yaml
-        chunks, meta_report = process_markdown_docs(
-            docs_dir, 
-            auto_generate_yaml=auto_generate_yaml,
-            overwrite_yaml=overwrite_yaml
-        )
-        typer.echo(f'Обработано чанков: {len(chunks)}')
-        if auto_generate_yaml:
-            typer.echo('✅ YAML файлы автоматически сгенерированы/обновлены')
-    except Exception as e:
-        logger.exception('Ошибка при обработке docs:')
-        typer.echo(f'Ошибка: {e}')
-        sys.exit(1)
+    # Чанки обрабатываются потоково и сразу уходят в LEANN, не накапливаясь в памяти
+    auto_generate_yaml = not no_auto_yaml
+    meta_report = {"processed": [], "errors": []}
+    chunks = _guard_processing(iter_markdown_docs(
+        docs_dir,
+        meta_report,
+        auto_generate_yaml=auto_generate_yaml,
+        overwrite_yaml=overwrite_yaml
+    ))
 
     if not dry_run:
         try:
+            # Создаём LEANN векторную БД
+            vector_store = get_vector_store()
+            
             # Определяем имя индекса
             if not index_name:
-                # Для LEANN используем имя первого документа или общее
+                # Для LEANN используем имя первого документа или общее.
+                # Отчёт заполняется по ходу обработки, поэтому дочитываем
+                # поток до первого чанка (или до конца, если чанков нет)
+                first_chunk = next(chunks, None)
+                if first_chunk is not None:
+                    chunks = chain([first_chunk], chunks)
                 if meta_report.get('processed'):
                     index_name = meta_report['processed'][0].get('doc_id', 'auto-rag-index')
                 else:
                     index_name = 'auto-rag-index'
             
-            # Создаём LEANN векторную БД
-            vector_store = get_vector_store()
             vector_store.upload_chunks(chunks, index_name)
             typer.echo(f'✅ Чанки загружены в LEANN (индекс: {index_name})')
             typer.echo(f'📁 Индекс сохранён в: .leann/indexes/{index_name}')
+        except ProcessingError as e:
+            # Документы не прочитаны - старый индекс остаётся на месте
+            _processing_failed(e)
         except ImportError as e:
             logger.warning(f'LEANN не установлен: {e}')
             typer.echo('⚠️  LEANN не установлен. Пропускаю загрузку.')
@@ -79,9 +118,18 @@ def run(
     else:
         typer.echo('[dry_run] Выгрузка в LEANN пропущена')
 
-    import json
-    with open(report_file, 'w', encoding='utf-8') as f:
-        json.dump(meta_report, f, ensure_ascii=False, indent=2)
+    try:
+        # Дочитываем поток (в dry_run или после неудачной загрузки), чтобы
+        # все YAML файлы были обработаны, а отчёт - полным
+        for _ in chunks:
+            pass
+        typer.echo(f'Обработано чанков: {sum(p["chunks"] for p in meta_report["processed"])}')
+        if auto_generate_yaml:
+            typer.echo('✅ YAML файлы автоматически сгенерированы/обновлены')
+    except Exception as e:
+        _processing_failed(e)
+
+    write_report(meta_report, report_file)
     typer.echo(f'Отчёт сохранён: {report_file}')
 
 if __name__ == '__main__':
@@ -2,16 +2,24 @@ import os
 import yaml
 import logging
 from pathlib import Path
-from typing import List, Dict, Tuple
-from markdown import markdown
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterator, List, Dict, Optional, Tuple
 from tqdm import tqdm
 
+# C-реализация из libyaml в разы быстрее чистого Python, но есть не во всех сборках PyYAML
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 # TODO: импортировать модельный вызов LLM и embedder
 # from embedder import embed_chunk
 
 logger = logging.getLogger(__name__)
 
-def load_yaml_metadata(md_file_path: Path) -> Dict:
+def load_yaml_metadata(md_file_path: Path) -> Tuple[Dict, Optional[Path]]:
     """Загрузка YAML метаданных из отдельного файла
     
     Ищет файл с тем же именем, но расширением .yaml или .yml
@@ -21,33 +29,26 @@ def load_yaml_metadata(md_file_path: Path) -> Dict:
         md_file_path: Путь к Markdown файлу
         
     Returns:
-        Словарь с метаданными или пустой словарь, если файл не найден
+        Кортеж (метаданные, путь к найденному YAML файлу).
+        Если файл не найден, возвращает ({}, None)
     """
-    # Пробуем .yaml сначала
-    yaml_path = md_file_path.with_suffix('.yaml')
-    if yaml_path.exists():
+    # Пробуем .yaml сначала, затем .yml. Файл сразу открываем, без
+    # предварительной проверки exists() - это лишний stat на каждый файл
+    for suffix in ('.yaml', '.yml'):
+        yaml_path = md_file_path.with_suffix(suffix)
         try:
             with open(yaml_path, encoding='utf-8') as f:
-                metadata = yaml.safe_load(f)
-                return metadata if metadata else {}
+                metadata = yaml.load(f, Loader=SafeLoader)
+                return (metadata if metadata else {}), yaml_path
+        except FileNotFoundError:
+            continue
         except Exception as e:
             # Логируем ошибку, но продолжаем работу
             logger.warning(f"Ошибка при чтении {yaml_path}: {e}")
-            return {}
-    
-    # Если .yaml не найден, пробуем .yml
-    yaml_path = md_file_path.with_suffix('.yml')
-    if yaml_path.exists():
-        try:
-            with open(yaml_path, encoding='utf-8') as f:
-                metadata = yaml.safe_load(f)
-                return metadata if metadata else {}
-        except Exception as e:
-            logger.warning(f"Ошибка при чтении {yaml_path}: {e}")
-            return {}
+            return {}, yaml_path
     
     # Если ни один файл не найден, возвращаем пустой словарь
-    return {}
+    return {}, None
 
 def generate_yaml_metadata(md_file_path: Path, doc_id: str, tags: List[str], overwrite: bool = False) -> Path:
     """Автоматическая генерация YAML файла с метаданными
@@ -67,7 +68,7 @@ def generate_yaml_metadata(md_file_path: Path, doc_id: str, tags: List[str], ove
     yaml_path = md_file_path.with_suffix('.yaml')
     
     # Если файл существует и не нужно перезаписывать, возвращаем путь
-    if yaml_path.exists() and not overwrite:
+    if not overwrite and yaml_path.exists():
         logger.debug(f"YAML файл уже существует: {yaml_path}, пропускаю генерацию")
         return yaml_path
     
@@ -79,8 +80,10 @@ def generate_yaml_metadata(md_file_path: Path, doc_id: str, tags: List[str], ove
     
     # Записываем YAML файл
     try:
-        with open(yaml_path, 'w', encoding='utf-8') as f:
-            yaml.dump(metadata, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        # Бинарный режим: libyaml сам кодирует в UTF-8, без текстовой обёртки Python
+        with open(yaml_path, 'wb') as f:
+            yaml.dump(metadata, f, Dumper=SafeDumper, allow_unicode=True, encoding='utf-8',
+                      default_flow_style=False, sort_keys=False)
         logger.info(f"✅ Создан YAML файл: {yaml_path}")
         return yaml_path
     except Exception as e:
@@ -89,30 +92,182 @@ def generate_yaml_metadata(md_file_path: Path, doc_id: str, tags: List[str], ove
 
 def split_to_chunks(content: str) -> List[str]:
     """Разбить markdown по ## (главы)"""
-    lines = content.splitlines()
-    chunks = []
-    buf = []
-    for line in lines:
-        if line.startswith('## '):
-            if buf:
-                chunks.append('\n'.join(buf).strip())
-                buf = []
-        buf.append(line)
-    if buf:
-        chunks.append('\n'.join(buf).strip())
-    return [ch for ch in chunks if ch]
+    return split_and_headers(content.encode('utf-8'))[0]
 
 def parse_all_headers(content: str) -> List[str]:
     """Получение всех заголовков второго уровня (## ...) как список тегов"""
-    return [line[3:].strip() for line in content.splitlines() if line.startswith('## ')]
+    return split_and_headers(content.encode('utf-8'))[1]
+
+def split_and_headers(content: bytes) -> Tuple[List[str], List[str]]:
+    """Разбить markdown по ## и собрать заголовки за один проход по строкам
+    
+    Работает с сырыми байтами файла: строки проверяются срезом без
+    декодирования, в UTF-8 декодируются только готовые чанки и заголовки.
+    Строки разбиваются по концам \\n, \\r\\n и \\r - для них результат
+    совпадает с разбиением текста через str.splitlines(). В отличие от него,
+    по \\x0c, \\x85, \\u2028 и другим юникодным разделителям строки не
+    разбиваются. split_to_chunks и parse_all_headers - обёртки над этой
+    функцией для уже декодированного текста.
+    """
+    lines = content.splitlines()
+    header_indices = [i for i, line in enumerate(lines) if line[:3] == b'## ']
+    headers = [lines[i][3:].decode('utf-8').strip() for i in header_indices]
+    bounds = [0] + header_indices + [len(lines)]
+    chunks = [b'\n'.join(lines[a:b]).decode('utf-8').strip() for a, b in zip(bounds, bounds[1:])]
+    return [ch for ch in chunks if ch], headers
 
 # Заглушка для тегирования: возвращает первый тег для каждого чанка
 def tag_chunks(chunks: List[str], tags: List[str]) -> List[str]:
-    results = []
-    for ch in chunks:
-        # TODO: заменить на вызов LLM-matcher
-        results.append(tags[0] if tags else 'Misc')
-    return results
+    # TODO: заменить на вызов LLM-matcher
+    default = tags[0] if tags else 'Misc'
+    return [default] * len(chunks)
+
+# Служебные каталоги, в которых не ищем документацию
+_SKIP_DIRS = {'.git', '.venv', 'venv', 'node_modules', '__pycache__', '.leann'}
+
+def _iter_markdown_files(docs_dir: Path, _subdir: bool = False) -> Iterator[Path]:
+    """Рекурсивный поиск .md файлов через os.scandir
+    
+    В отличие от Path.rglob не заходит в служебные каталоги из _SKIP_DIRS.
+    Как и rglob, пропускает подкаталоги, которые нельзя прочитать.
+    Порядок как у rglob: файлы каталога, затем подкаталоги.
+    """
+    subdirs = []
+    try:
+        it = os.scandir(docs_dir)
+    except OSError as e:
+        if not _subdir:
+            raise
+        logger.warning(f"Пропускаю каталог {docs_dir}: {e}")
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in _SKIP_DIRS:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith('.md') and entry.is_file():
+                yield Path(entry.path)
+    for subdir in subdirs:
+        yield from _iter_markdown_files(subdir, _subdir=True)
+
+def _process_one(f: Path, auto_generate_yaml: bool, overwrite_yaml: bool) -> Tuple[List[dict], dict]:
+    """Обработка одного Markdown файла
+
+    Returns:
+        Tuple[List[dict], dict]: Чанки файла и запись для отчёта
+    """
+    # Читаем Markdown файл целиком как байты (декодируются только чанки)
+    md_content = f.read_bytes()
+    
+    # Загружаем YAML метаданные из отдельного файла
+    metadata, found_yaml_path = load_yaml_metadata(f)
+    
+    # Разбиваем на чанки и парсим заголовки за один проход
+    chunks, tags_from_headers = split_and_headers(md_content)
+    
+    # Извлекаем теги из метаданных или берём заголовки
+    tags_from_metadata = metadata.get('tags', [])
+    
+    # Если нужно перезаписать YAML, используем имя файла и теги из заголовков
+    # Иначе используем данные из YAML, если они есть
+    if overwrite_yaml:
+        doc_id = f.stem
+        tags = tags_from_headers
+    else:
+        doc_id = metadata.get('doc_id', f.stem)
+        if tags_from_metadata:
+            tags = tags_from_metadata if isinstance(tags_from_metadata, list) else [tags_from_metadata]
+        else:
+            tags = tags_from_headers
+    
+    # Автоматически генерируем YAML файл если его нет или нужно обновить
+    if auto_generate_yaml:
+        # Обновляем doc_id и tags если они изменились или файла нет.
+        # Генерируется всегда .yaml, поэтому найденный .yml не считается
+        yaml_exists = found_yaml_path is not None and found_yaml_path.suffix == '.yaml'
+        # Дешёвые проверки идут первыми; stat не нужен - наличие файла уже известно
+        should_generate = (
+            overwrite_yaml or  # Нужно перезаписать
+            not yaml_exists or  # Файла нет
+            metadata.get('doc_id') != doc_id or  # doc_id изменился
+            (not tags_from_metadata and tags_from_headers)  # Теги нужно обновить из заголовков
+        )
+        
+        # Существующий файл без overwrite_yaml generate_yaml_metadata всё равно не тронет,
+        # поэтому не вызываем её и не делаем внутри лишний exists()
+        can_write = overwrite_yaml or not yaml_exists
+        
+        # Не перезаписываем файл, если на диске уже ровно то, что сгенерируем
+        up_to_date = yaml_exists and metadata == {'doc_id': doc_id, 'tags': tags if tags else []}
+        
+        if should_generate and can_write and not up_to_date:
+            generate_yaml_metadata(f, doc_id, tags, overwrite=True)
+    
+    chunk_tags = tag_chunks(chunks, tags)
+
+    file_chunks = []
+    for c, t in zip(chunks, chunk_tags):
+        chunk_obj = {
+            "text": c,
+            "metadata": {
+                "doc_id": doc_id,
+                "tag": t,
+                "tags": tags
+            },
+            "path": str(f)
+        }
+        file_chunks.append(chunk_obj)
+
+    return file_chunks, {
+        "file": str(f),
+        "doc_id": doc_id,
+        "tags": tags,
+        "chunks": len(chunks)
+    }
+
+def iter_markdown_docs(docs_dir: Path, report: dict, auto_generate_yaml: bool = True,
+                       overwrite_yaml: bool = False) -> Iterator[dict]:
+    """Потоковая обработка Markdown документов в директории
+    
+    Чанки отдаются по мере обработки файлов, не накапливаясь в памяти.
+    Отчёт заполняется по ходу итерации и полон только после её завершения.
+    
+    Args:
+        docs_dir: Директория с Markdown файлами
+        report: Словарь отчёта {"processed": [...], "errors": [...]} для заполнения
+        auto_generate_yaml: Автоматически генерировать YAML файлы если их нет (по умолчанию True)
+        overwrite_yaml: Перезаписывать существующие YAML файлы (по умолчанию False)
+        
+    Yields:
+        dict: Чанки в исходном порядке файлов
+    """
+    md_files = list(_iter_markdown_files(docs_dir))
+    files = iter(md_files)
+
+    # Обработка файлов упирается в I/O, поэтому распараллеливаем потоками.
+    # В работе одновременно не больше 2 * max_workers файлов, чтобы не держать
+    # в памяти чанки всего корпуса; результаты отдаются в исходном порядке файлов.
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(md_files), desc='docs') as progress:
+        pending = deque(
+            (f, executor.submit(_process_one, f, auto_generate_yaml, overwrite_yaml))
+            for f in islice(files, max_workers * 2)
+        )
+        while pending:
+            f, future = pending.popleft()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file, executor.submit(_process_one, next_file, auto_generate_yaml, overwrite_yaml)))
+            try:
+                file_chunks, entry = future.result()
+            except Exception as e:
+                report["errors"].append({"file": str(f), "err": str(e)})
+                continue
+            finally:
+                progress.update(1)
+            report["processed"].append(entry)
+            yield from file_chunks
 
 def process_markdown_docs(docs_dir: Path, auto_generate_yaml: bool = True, overwrite_yaml: bool = False):
     """Обработка всех Markdown документов в директории
@@ -125,72 +280,6 @@ def process_markdown_docs(docs_dir: Path, auto_generate_yaml: bool = True, overw
     Returns:
         Tuple[List[dict], dict]: Список чанков и отчёт об обработке
     """
-    all_chunks = []
     report = {"processed": [], "errors": []}
-
-    md_files = list(docs_dir.rglob('*.md'))
-
-    for f in tqdm(md_files, desc='docs'):
-        try:
-            # Читаем Markdown файл
-            with open(f, encoding='utf-8') as fh:
-                md_content = fh.read()
-            
-            # Загружаем YAML метаданные из отдельного файла
-            metadata = load_yaml_metadata(f)
-            
-            # Извлекаем теги из метаданных или парсим заголовки
-            tags_from_metadata = metadata.get('tags', [])
-            tags_from_headers = parse_all_headers(md_content)
-            
-            # Если нужно перезаписать YAML, используем имя файла и теги из заголовков
-            # Иначе используем данные из YAML, если они есть
-            if overwrite_yaml:
-                doc_id = f.stem
-                tags = tags_from_headers
-            else:
-                doc_id = metadata.get('doc_id', f.stem)
-                if tags_from_metadata:
-                    tags = tags_from_metadata if isinstance(tags_from_metadata, list) else [tags_from_metadata]
-                else:
-                    tags = tags_from_headers
-            
-            # Автоматически генерируем YAML файл если его нет или нужно обновить
-            if auto_generate_yaml:
-                # Обновляем doc_id и tags если они изменились или файла нет
-                yaml_path = f.with_suffix('.yaml')
-                should_generate = (
-                    not yaml_path.exists() or  # Файла нет
-                    overwrite_yaml or  # Нужно перезаписать
-                    metadata.get('doc_id') != doc_id or  # doc_id изменился
-                    (not tags_from_metadata and tags_from_headers)  # Теги нужно обновить из заголовков
-                )
-                
-                if should_generate:
-                    generate_yaml_metadata(f, doc_id, tags, overwrite=overwrite_yaml or not yaml_path.exists())
-            
-            # Разбиваем на чанки
-            chunks = split_to_chunks(md_content)
-            chunk_tags = tag_chunks(chunks, tags)
-
-            for c, t in zip(chunks, chunk_tags):
-                chunk_obj = {
-                    "text": c,
-                    "metadata": {
-                        "doc_id": doc_id,
-                        "tag": t,
-                        "tags": tags
-                    },
-                    "path": str(f)
-                }
-                all_chunks.append(chunk_obj)
-
-            report["processed"].append({
-                "file": str(f),
-                "doc_id": doc_id,
-                "tags": tags,
-                "chunks": len(chunks)
-            })
-        except Exception as e:
-            report["errors"].append({"file": str(f), "err": str(e)})
+    all_chunks = list(iter_markdown_docs(docs_dir, report, auto_generate_yaml, overwrite_yaml))
     return all_chunks, report
@@ -0,0 +1,89 @@
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import embedder
+
+
+def _sections(n, length, seed=0):
+    """Синтетические разделы: слова из словаря с распределением Ципфа"""
+    rnd = random.Random(seed)
+    vocab = [f"w{i}" for i in range(3000)]
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    return [' '.join(rnd.choices(vocab, weights, k=length)) for _ in range(n)], vocab, rnd
+
+
+def _edit_one_word(text, vocab, rnd):
+    words = text.split()
+    words[rnd.randrange(len(words))] = rnd.choice(vocab)
+    return ' '.join(words)
+
+
+def _distance(a, b):
+    return bin(embedder._simhash(a) ^ embedder._simhash(b)).count('1')
+
+
+@pytest.mark.parametrize('length, min_rate', [(50, 0.8), (100, 0.9)])
+def test_simhash_reuses_one_word_edits(length, min_rate):
+    # Замена одного слова в разделе из 50/100 слов - правка 2%/1%
+    sections, vocab, rnd = _sections(300, length)
+    reused = sum(
+        _distance(text, _edit_one_word(text, vocab, rnd)) <= embedder.EMBED_SIMHASH_DISTANCE
+        for text in sections
+    )
+    assert reused / len(sections) >= min_rate
+
+
+@pytest.mark.parametrize('length', [50, 100])
+def test_simhash_keeps_unrelated_sections_apart(length):
+    sections, _, _ = _sections(100, length, seed=1)
+    pairs = [(a, b) for i, a in enumerate(sections) for b in sections[i + 1:]]
+    collisions = sum(_distance(a, b) <= embedder.EMBED_SIMHASH_DISTANCE for a, b in pairs)
+    assert collisions / len(pairs) < 0.001
+
+
+def test_simhash_bands_find_every_neighbour_within_distance():
+    rnd = random.Random(2)
+    for _ in range(1000):
+        simhash = rnd.getrandbits(64)
+        other = simhash
+        for bit in rnd.sample(range(64), embedder.EMBED_SIMHASH_DISTANCE):
+            other ^= 1 << bit
+        assert set(enumerate(embedder._simhash_bands(simhash))) & set(enumerate(embedder._simhash_bands(other)))
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """Чистый SQLite-кэш во временной директории"""
+    monkeypatch.setattr(embedder, 'EMBED_CACHE_PATH', str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setattr(embedder, '_cache_local', threading.local())
+    monkeypatch.setattr(embedder, '_cache_ready', False)
+    monkeypatch.setattr(embedder, '_cache_failed', False)
+    embedder._cached_blob.cache_clear()
+    yield
+    embedder._cached_blob.cache_clear()
+
+
+def test_cache_is_usable_from_worker_threads(cache):
+    key = embedder._cache_key('m', 'text')
+    embedder._store_vectors([key], [[0.5, 0.25]])
+    embedder._cached_blob.cache_clear()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert pool.submit(embedder._cached_vector, key).result() == [0.5, 0.25]
+        other = embedder._cache_key('m', 'other')
+        pool.submit(embedder._store_vectors, [other], [[1.0, 0.0]]).result()
+    assert embedder._cached_vector(other) == [1.0, 0.0]
+
+
+def test_cache_read_error_is_a_miss(cache):
+    class LockedConnection:
+        def execute(self, *args):
+            raise sqlite3.OperationalError('database is locked')
+
+    embedder._cache_local.conn = LockedConnection()
+    with pytest.raises(KeyError):
+        embedder._cached_vector(embedder._cache_key('m', 'text'))
+    assert embedder._similar_vector('m', 0) is None
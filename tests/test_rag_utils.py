@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import rag_utils
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('# doc\n', encoding='utf-8')
+
+
+def test_iter_markdown_files_skips_only_service_dirs(tmp_path):
+    for name in ('a.md', '.vuepress/b.md', '.github/c.md', 'sub/d.md',
+                 'node_modules/x.md', '.git/y.md', 'notes.txt'):
+        _touch(tmp_path / name)
+    found = {p.relative_to(tmp_path).as_posix() for p in rag_utils._iter_markdown_files(tmp_path)}
+    assert found == {'a.md', '.vuepress/b.md', '.github/c.md', 'sub/d.md'}
+
+
+def test_iter_markdown_files_skips_unreadable_subdir(tmp_path, monkeypatch):
+    for name in ('a.md', 'locked/b.md', 'open/c.md'):
+        _touch(tmp_path / name)
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(rag_utils.os, 'scandir', fake_scandir)
+    found = {p.relative_to(tmp_path).as_posix() for p in rag_utils._iter_markdown_files(tmp_path)}
+    assert found == {'a.md', 'open/c.md'}
+
+
+def _reference_split(text):
+    """Исходный алгоритм на str.splitlines(), с которым сверяется split_and_headers"""
+    lines = text.splitlines()
+    header_indices = [i for i, line in enumerate(lines) if line.startswith('## ')]
+    bounds = [0] + header_indices + [len(lines)]
+    chunks = ['\n'.join(lines[a:b]).strip() for a, b in zip(bounds, bounds[1:])]
+    headers = [line[3:].strip() for line in text.splitlines() if line.startswith('## ')]
+    return [ch for ch in chunks if ch], headers
+
+
+_MARKDOWN = [
+    '',
+    'без заголовков\nвторая строка',
+    '# Документ\nвступление\n\n## Глава 1\nтекст\n## Глава 2  \n\nещё текст\n',
+    '## Сразу заголовок\n## Пустая глава\n\n## Последняя\nконец',
+    '##без пробела\n ## с отступом\n### третий уровень\n## Настоящий\nтекст',
+]
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+@pytest.mark.parametrize('text', _MARKDOWN)
+def test_split_and_headers_matches_str_splitlines(text, newline):
+    text = text.replace('\n', newline)
+    expected = _reference_split(text)
+    assert rag_utils.split_and_headers(text.encode('utf-8')) == expected
+    assert rag_utils.split_to_chunks(text) == expected[0]
+    assert rag_utils.parse_all_headers(text) == expected[1]
+
+
+def test_split_and_headers_keeps_unicode_separators_inside_lines():
+    # str.splitlines() разбил бы строку по \x0c и принял "## ..." за заголовок
+    text = 'вступление\x0c## не заголовок\n## Глава\nтекст'
+    chunks, headers = rag_utils.split_and_headers(text.encode('utf-8'))
+    assert headers == ['Глава']
+    assert chunks == ['вступление\x0c## не заголовок', '## Глава\nтекст']
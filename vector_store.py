@@ -2,23 +2,61 @@
 Интеграция с LEANN - локальной векторной БД с экономией памяти до 97%.
 """
 import os
+import inspect
+import importlib
 import logging
-from typing import List, Dict
+from functools import lru_cache
+from itertools import islice
+from typing import TYPE_CHECKING, Iterable, List, Dict, Optional
 from pathlib import Path
 
-# LEANN
-try:
-    from leann import Builder, Searcher
-    HAS_LEANN = True
-except ImportError:
-    HAS_LEANN = False
+# numpy и embedder (asyncio, sqlite3) нужны только при загрузке чанков,
+# поэтому импортируются внутри upload_chunks
+if TYPE_CHECKING:
+    import numpy as np
+
+
+@lru_cache(maxsize=None)
+def _has_leann() -> bool:
+    """Проверяет доступность LEANN (импорт выполняется один раз, при первой проверке)"""
+    try:
+        importlib.import_module('leann')
+        return True
+    except ImportError:
+        return False
+
+
+def _accepts_embedding(add_text) -> bool:
+    """Проверяет, принимает ли add_text готовый вектор (аргумент embedding)"""
+    try:
+        return 'embedding' in inspect.signature(add_text).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _remove_path(path: Path) -> None:
+    """Удаляет файл или директорию индекса, если они существуют"""
+    if path.is_dir():
+        import shutil
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _normalize(vectors: List[List[float]]) -> "np.ndarray":
+    """L2-нормализация батча векторов одной векторной операцией"""
+    import numpy as np
+    
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+    return matrix
 
 
 class LEANNStore:
     """Реализация для LEANN - локальная векторная БД с экономией памяти"""
     
     def __init__(self, index_dir: str = ".leann/indexes"):
-        if not HAS_LEANN:
+        if not _has_leann():
             error_msg = (
                 "LEANN не установлен или недоступен для вашей системы.\n"
                 "Попробуйте:\n"
@@ -31,57 +69,79 @@ class LEANNStore:
         self.index_dir = Path(index_dir)
         self.index_dir.mkdir(parents=True, exist_ok=True)
         self.builder = None
-        self.searcher = None
+        # Searcher на каждый индекс: повторное создание грузит граф и модель эмбеддингов
+        self.searchers = {}
         self.current_index_name = None
     
-    def upload_chunks(self, chunks: List[Dict], index_name: str) -> None:
-        """Загружает чанки в LEANN индекс"""
-        logging.info(f"Начинаю загрузку {len(chunks)} чанков в LEANN (индекс: {index_name})...")
+    def upload_chunks(self, chunks: Iterable[Dict], index_name: str) -> None:
+        """Загружает чанки в LEANN индекс
         
-        index_path = self.index_dir / index_name
+        chunks может быть генератором: чанки читаются окнами, и в памяти
+        одновременно находится только одно окно вместе с его векторами.
+        """
+        logging.info(f"Начинаю загрузку чанков в LEANN (индекс: {index_name})...")
         
-        # Если индекс уже существует, удаляем его для пересоздания
-        if index_path.exists():
-            import shutil
-            logging.info(f"Удаляю существующий индекс: {index_path}")
-            shutil.rmtree(index_path)
+        index_path = self.index_dir / index_name
+        # Индекс собирается во временной директории и заменяет старый только
+        # после успешной сборки: ошибка в документах не оставит пустой индекс
+        build_path = self.index_dir / f".{index_name}.building"
+        _remove_path(build_path)
         
         try:
+            from leann import Builder
+            from embedder import embed_chunks, EMBED_BATCH_SIZE, EMBED_CONCURRENCY, EMBED_MODEL
+            
             # Создаём Builder для нового индекса
             # LEANN использует graph-based структуру с selective recomputation
             embedding_model = os.getenv('LEANN_EMBEDDING_MODEL', 'facebook/contriever')
             backend = os.getenv('LEANN_BACKEND', 'hnsw')  # 'hnsw' или 'diskann'
             
             self.builder = Builder(
-                index_path=str(index_path),
+                index_path=str(build_path),
                 embedding_model=embedding_model,
                 backend=backend
             )
             
-            # Добавляем чанки с метаданными
-            for i, c in enumerate(chunks):
-                text = c['text']
-                metadata = c['metadata']
+            # Если Builder принимает готовые векторы, считаем их батчами
+            # (один запрос к API на EMBED_BATCH_SIZE чанков). За раз берём
+            # столько чанков, чтобы занять все EMBED_CONCURRENCY параллельных запросов.
+            # Векторы должны быть из той же модели, которой LEANN эмбеддит запросы
+            use_embeddings = _accepts_embedding(self.builder.add_text)
+            if use_embeddings and embedding_model != EMBED_MODEL:
+                logging.info(
+                    f"Модель LEANN ({embedding_model}) не совпадает с EMBED_MODEL ({EMBED_MODEL}): "
+                    f"готовые векторы не используются, LEANN эмбеддит тексты сам"
+                )
+                use_embeddings = False
+            window = EMBED_BATCH_SIZE * EMBED_CONCURRENCY
+            
+            chunks = iter(chunks)
+            start = 0
+            while True:
+                batch = list(islice(chunks, window))
+                if not batch:
+                    break
+                vectors = [None] * len(batch)
+                if use_embeddings:
+                    # Чанки без настоящего вектора (нет ключа API, ошибка батча)
+                    # добавляются только текстом - их эмбеддит сам LEANN
+                    embedded = embed_chunks([c['text'] for c in batch], model=EMBED_MODEL, fallback=False)
+                    found = [j for j, vector in enumerate(embedded) if vector is not None]
+                    if found:
+                        for j, vector in zip(found, _normalize([embedded[j] for j in found])):
+                            vectors[j] = vector
                 
-                # LEANN поддерживает метаданные для фильтрации
-                # Метод add_text принимает текст и опциональные метаданные
-                try:
-                    self.builder.add_text(
-                        text=text,
-                        metadata=metadata
-                    )
-                except Exception as e:
-                    logging.warning(f"Ошибка при добавлении чанка {i}: {e}")
-                    # Пробуем без метаданных
-                    self.builder.add_text(text=text)
+                for i, (c, vector) in enumerate(zip(batch, vectors), start=start):
+                    self._add_chunk(i, c, vector)
                 
-                if (i + 1) % 100 == 0:
-                    logging.info(f"Обработано {i + 1} из {len(chunks)} чанков")
+                start += len(batch)
+                logging.info(f"Обработано {start} чанков")
             
             # Финальная сборка индекса
             # LEANN строит графовую структуру вместо хранения всех эмбеддингов
             logging.info("Сборка LEANN индекса (это может занять время)...")
             self.builder.build()
+            self._replace_index(build_path, index_path)
             logging.info(f"✅ LEANN индекс создан: {index_path}")
             logging.info(f"💾 Экономия хранилища: ~97% по сравнению с традиционными векторными БД")
             
@@ -89,8 +149,61 @@ class LEANNStore:
             
         except Exception as e:
             logging.error(f"Ошибка при создании LEANN индекса: {e}")
+            _remove_path(build_path)
             raise
     
+    def _replace_index(self, build_path: Path, index_path: Path) -> None:
+        """Заменяет существующий индекс только что собранным"""
+        old_path = self.index_dir / f".{index_path.name}.old"
+        _remove_path(old_path)
+        if index_path.exists():
+            logging.info(f"Заменяю существующий индекс: {index_path}")
+            index_path.rename(old_path)
+        build_path.rename(index_path)
+        # Searcher старой версии индекса больше не действителен
+        self.searchers.pop(index_path.name, None)
+        _remove_path(old_path)
+    
+    def _add_chunk(self, i: int, chunk: Dict, embedding=None) -> None:
+        """Добавляет один чанк в Builder (с готовым вектором, если он есть)"""
+        text = chunk['text']
+        metadata = chunk['metadata']
+        kwargs = {'embedding': embedding} if embedding is not None else {}
+        
+        # LEANN поддерживает метаданные для фильтрации
+        # Метод add_text принимает текст и опциональные метаданные
+        try:
+            self.builder.add_text(
+                text=text,
+                metadata=metadata,
+                **kwargs
+            )
+        except Exception as e:
+            logging.warning(f"Ошибка при добавлении чанка {i}: {e}")
+            # Пробуем без метаданных
+            self.builder.add_text(text=text, **kwargs)
+    
+    def get_searcher(self, index_name: Optional[str] = None):
+        """Возвращает Searcher для индекса (по умолчанию - текущего)
+        
+        Searcher создаётся при первом обращении и переиспользуется:
+        создание загружает граф и модель эмбеддингов.
+        """
+        index_name = index_name or self.current_index_name
+        if index_name is None:
+            raise ValueError("Индекс не создан. Сначала загрузите чанки.")
+        
+        searcher = self.searchers.get(index_name)
+        if searcher is None:
+            index_path = self.index_dir / index_name
+            if not index_path.exists():
+                raise ValueError(f"Индекс не найден: {index_path}")
+            
+            from leann import Searcher
+            searcher = Searcher(index_path=str(index_path))
+            self.searchers[index_name] = searcher
+        return searcher
+    
     def search(self, query: str, top_k: int = 5) -> List[Dict]:
         """Поиск в LEANN индексе
         
@@ -98,21 +211,12 @@ class LEANNStore:
         только для узлов в пути поиска, что обеспечивает быстрый поиск
         при минимальном использовании памяти.
         """
-        if self.current_index_name is None:
-            raise ValueError("Индекс не создан. Сначала загрузите чанки.")
-        
-        index_path = self.index_dir / self.current_index_name
-        
-        if not index_path.exists():
-            raise ValueError(f"Индекс не найден: {index_path}")
-        
         try:
-            if self.searcher is None:
-                self.searcher = Searcher(index_path=str(index_path))
+            searcher = self.get_searcher()
             
             # LEANN автоматически вычисляет эмбеддинги для запроса
             # и использует graph traversal для поиска
-            results = self.searcher.search(query=query, top_k=top_k)
+            results = searcher.search(query=query, top_k=top_k)
             return results
         except Exception as e:
             logging.error(f"Ошибка при поиске в LEANN: {e}")
@@ -123,10 +227,18 @@ def get_vector_store(index_dir: str = ".leann/indexes") -> LEANNStore:
     """
     Создаёт экземпляр LEANN векторной БД
     
+    Для одной и той же директории (в любом написании пути) возвращается
+    один и тот же экземпляр, чтобы его Searcher'ы переиспользовались между запросами.
+    
     Args:
         index_dir: Директория для хранения индексов
     
     Returns:
         Экземпляр LEANNStore
     """
+    return _get_vector_store(str(Path(index_dir).resolve()))
+
+
+@lru_cache(maxsize=8)
+def _get_vector_store(index_dir: str) -> LEANNStore:
     return LEANNStore(index_dir=index_dir)